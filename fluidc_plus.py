@@ -41,93 +41,176 @@ Output: C
 
 import argparse
 import random
-from collections import Counter
-from copy import deepcopy
 
 import numpy as np
+from numba import njit
 from sklearn.metrics.cluster import normalized_mutual_info_score as nmi
 
 from asyn_fluid_communities import asyn_fluidc
-from utils import nodes_color, _invert_dict, graph_loader, gt_loader, plot_communities, print_metrics
+from utils import nodes_color, graph_loader, graph_to_csr, gt_loader, plot_communities, print_metrics
 
 
-def fluidc_modified(G, vertices, communities, density, max_density, com_to_numvertices, max_iter):
+@njit(cache=True)
+def _fluidc_kernel(indptr, indices, order, comm, stamps, num_verts, density, max_density, max_iter, cand_ids,
+                   cand_weights, change_threshold, shuffle_every, seed):
+    """
+    FluidC update loop on CSR arrays, compiled with Numba
+    Args:
+        indptr: CSR row pointers (int32 array)
+        indices: CSR neighbour indices (int32 array)
+        order: vertices visiting order (int32 array)
+        comm: community of each vertex, -1 if not assigned yet (int32 array, updated in place)
+        stamps: assignment order of each vertex, the assigned ones numbered 0..a-1 (int32 array, updated in place
+            when a vertex gets its first community)
+        num_verts: number of vertices of each community (int32 array, updated in place)
+        density: density of each community (float64 array, updated in place)
+        max_density: maximum density (float)
+        max_iter: maximum number of iterations (int)
+        cand_ids: scratch buffer for candidate communities, at least max degree + 1 long (int32 array)
+        cand_weights: scratch buffer for candidate densities, same length as cand_ids (float64 array)
+        change_threshold: stop when at most this number of vertices changed community in an iteration (int)
+        shuffle_every: shuffle the visiting order every shuffle_every iterations, 0 to keep it fixed (int)
+        seed: random seed for the visiting order shuffle (int)
+
+    Returns:
+        number of iterations performed (int)
+    """
+    # Visit a copy of the order when it gets shuffled, so the degree order given as input is preserved
+    visit = order
+    if shuffle_every > 0:
+        np.random.seed(seed)
+        visit = order.copy()
+
+    # Next stamp for vertices getting their first community
+    next_stamp = 0
+    for vertex in range(comm.shape[0]):
+        if comm[vertex] >= 0:
+            next_stamp += 1
 
     # Set up control variables and start iterating
     iter_count = 0
-    cont = True
-    while cont:
-        cont = False
+    num_changed = change_threshold + 1
+    while num_changed > change_threshold:
+        num_changed = 0
         iter_count += 1
-        # Commented since vertices are ordered wrt their degrees
-        # vertices = list(G)
-        # random.shuffle(vertices)
+        # Break stable oscillations by periodically changing the visiting order
+        if shuffle_every > 0 and iter_count % shuffle_every == 0:
+            np.random.shuffle(visit)
 
-        for vertex in vertices:
+        for vertex in visit:
             # Updating rule
-            com_counter = Counter()
-            # Take into account self vertex community
-            try:
-                com_counter.update({communities[vertex]: density[communities[vertex]]})
-            except KeyError:
-                pass
-            # Gather neighbour vertex communities
-            for v in G[vertex]:
-                try:
-                    com_counter.update({communities[v]: density[communities[v]]})
-                except KeyError:
+            num_cands = 0
+            # Take into account self vertex community (always stored first)
+            own_com = comm[vertex]
+            if own_com >= 0:
+                cand_ids[0] = own_com
+                cand_weights[0] = density[own_com]
+                num_cands = 1
+            # Gather neighbour vertex communities by linear scan over the candidates
+            for j in range(indptr[vertex], indptr[vertex + 1]):
+                c = comm[indices[j]]
+                if c < 0:
                     continue
+                found = False
+                for m in range(num_cands):
+                    if cand_ids[m] == c:
+                        cand_weights[m] += density[c]
+                        found = True
+                        break
+                if not found:
+                    cand_ids[num_cands] = c
+                    cand_weights[num_cands] = density[c]
+                    num_cands += 1
+            if num_cands == 0:
+                continue
+
             # Check which is the community with highest density
+            max_freq = cand_weights[0]
+            for m in range(1, num_cands):
+                if cand_weights[m] > max_freq:
+                    max_freq = cand_weights[m]
+            # If actual vertex com in best communities, it is preserved
+            if own_com >= 0 and (max_freq - cand_weights[0]) < 0.0001:
+                continue
+
+            # Among the best communities, select the one with the lowest density (i.e. the most vertices)
             new_com = -1
-            if len(com_counter.keys()) > 0:
-                max_freq = max(com_counter.values())
-                best_communities = [com for com, freq in com_counter.items()
-                                    if (max_freq - freq) < 0.0001]
-                # If actual vertex com in best communities, it is preserved
-                try:
-                    if communities[vertex] in best_communities:
-                        new_com = communities[vertex]
-                except KeyError:
-                    pass
-                # If vertex community changes...
-                if new_com == -1:
-                    # Set flag of non-convergence
-                    cont = True
-
-                    # Instead of using random selection, community are selected considering the number of nodes
-                    # (density)
-                    # new_com = random.choice(best_communities)
-                    if len(best_communities) > 1:
-                        com_densities = [max_density / com_to_numvertices[b] for b in best_communities]
-                        new_com = best_communities[np.argmin(com_densities)]
-                    else:
-                        new_com = best_communities[0]
-
-                    # Update previous community status
-                    try:
-                        com_to_numvertices[communities[vertex]] -= 1
-                        density[communities[vertex]] = max_density / com_to_numvertices[communities[vertex]]
-                    except KeyError:
-                        pass
-                    # Update new community status
-                    communities[vertex] = new_com
-                    com_to_numvertices[communities[vertex]] += 1
-                    density[communities[vertex]] = max_density / com_to_numvertices[communities[vertex]]
+            min_density = 0.0
+            for m in range(num_cands):
+                if (max_freq - cand_weights[m]) < 0.0001:
+                    # density is kept in sync with max_density / num_verts on every membership change
+                    com_density = density[cand_ids[m]]
+                    if new_com == -1 or com_density < min_density:
+                        new_com = cand_ids[m]
+                        min_density = com_density
+
+            # Count vertices changing community (non-convergence)
+            num_changed += 1
+
+            # Update previous community status
+            if own_com >= 0:
+                num_verts[own_com] -= 1
+                density[own_com] = max_density / num_verts[own_com]
+            else:
+                stamps[vertex] = next_stamp
+                next_stamp += 1
+            # Update new community status
+            comm[vertex] = new_com
+            num_verts[new_com] += 1
+            density[new_com] = max_density / num_verts[new_com]
         # If maximum iterations reached --> output actual results
         if iter_count > max_iter:
-            print('Exiting by max iterations!')
             break
-    # Return results by grouping communities as list of vertices
-    return list(_invert_dict(communities).values())
+    return iter_count
+
+
+def fluidc_modified(indptr, indices, vertices, communities, stamps, density, max_density, com_to_numvertices,
+                    max_iter, cand_ids, cand_weights, change_threshold=0, shuffle_every=0):
+    """
+    Modified FluidC on CSR arrays: vertices are visited in the given order and ties are broken by community size
+    Args:
+        indptr: CSR row pointers of the input graph, nodes labelled 0..n-1 (int32 array)
+        indices: CSR neighbour indices (int32 array)
+        vertices: vertices visiting order (int32 array)
+        communities: community of each vertex, -1 if not assigned yet (int32 array, updated in place)
+        stamps: assignment order of each vertex, seeds numbered 0..s-1 (int32 array, updated in place)
+        density: density of each community (float64 array, updated in place)
+        max_density: maximum density (float)
+        com_to_numvertices: number of vertices of each community (int32 array, updated in place)
+        max_iter: maximum number of iterations (int)
+        cand_ids: scratch buffer for candidate communities, at least max degree + 1 long (int32 array)
+        cand_weights: scratch buffer for candidate densities, same length as cand_ids (float64 array)
+        change_threshold: stop when at most this number of vertices changed community in an iteration (int)
+        shuffle_every: shuffle the visiting order every shuffle_every iterations, 0 to keep it fixed (int)
+
+    Returns:
+        communities found (lists of nodes, seed first and then in order of first assignment)
+    """
+    # Draw the kernel shuffle seed from random only when needed, so seeded runs without shuffling are unchanged
+    seed = random.getrandbits(32) if shuffle_every > 0 else 0
 
+    # communities, density and com_to_numvertices are arrays indexed by vertex / community id, updated in place
+    iter_count = _fluidc_kernel(indptr, indices, vertices, communities, stamps, com_to_numvertices, density,
+                                max_density, max_iter, cand_ids, cand_weights, change_threshold, shuffle_every, seed)
+    if iter_count > max_iter:
+        print('Exiting by max iterations!')
 
-def fluidc_plus(G, k, max_iter=100):
+    # Return results by grouping communities as list of vertices: sorting by community id puts unassigned
+    # vertices (-1) first, then each community with its vertices in assignment order
+    members = np.lexsort((stamps, communities))
+    sizes = np.bincount(communities + 1, minlength=len(com_to_numvertices) + 1)
+    groups = np.split(members, np.cumsum(sizes)[:-1])[1:]
+    return [group.tolist() for group in groups if len(group)]
+
+
+def fluidc_plus(G, k, max_iter=100, shuffle_every=0):
     """
 
     Args:
-        G: input graph (networkX graph)
+        G: input graph (networkX graph), nodes must be labelled 0..n-1 (e.g. by convert_node_labels_to_integers)
         k: number of communities (int)
         max_iter: maximum number of FluidC+ iterations (int)
+        shuffle_every: shuffle the degree-sorted vertices every shuffle_every FluidC iterations, 0 to disable (int)
 
     Returns:
         communities found (lists of nodes)
@@ -140,16 +223,31 @@ def fluidc_plus(G, k, max_iter=100):
     vertices = list(G)
     random.shuffle(vertices)
     seed_set = {n: i for i, n in enumerate(vertices[:k])}
-    bad_seed_set = {} | seed_set
+    bad_seed_set = set(seed_set)
+
+    # Adjacency as CSR arrays for the compiled FluidC loop
+    indptr, indices = graph_to_csr(G)
+
+    # Sort by nodes degree, degrees are indexed by node id as in the CSR arrays.
+    # The stable sort keeps ties in G iteration order, which is not necessarily the node id order
+    degrees = np.diff(indptr)
+    nodes = np.fromiter(G, dtype=np.int32, count=len(G))
+    sorted_vertices = nodes[np.argsort(-degrees[nodes], kind='stable')]
 
-    # Sort by nodes degree
-    sorted_vertices = sorted(G.degree, key=lambda x: x[1], reverse=True)
-    sorted_vertices = [x[0] for x in sorted_vertices]
+    # Scratch buffers for the candidate communities of a vertex (at most its degree + its own community),
+    # allocated once and reused by every FluidC call
+    max_degree = int(degrees.max()) if len(degrees) else 0
+    cand_ids = np.empty(max_degree + 1, dtype=np.int32)
+    cand_weights = np.empty(max_degree + 1, dtype=np.float64)
 
     seed_init_num = 0
     iter = 0
-    density = {}
-    com_to_numvertices = {}
+    # Communities status as arrays: vertex community (-1 if not assigned), community density and size
+    communities = np.full(len(G), -1, dtype=np.int32)
+    # Assignment order of the vertices, so communities are returned seed first and then by first assignment
+    stamps = np.zeros(len(G), dtype=np.int32)
+    density = np.zeros(k, dtype=np.float64)
+    com_to_numvertices = np.zeros(k, dtype=np.int32)
     old_communities = None
     new_communities = None
     nmi_list = []
@@ -157,22 +255,28 @@ def fluidc_plus(G, k, max_iter=100):
     while seed_init_num < 10 and iter < max_iter:
 
         # Initialize communities seed and vertices density
-        for v in seed_set:
-            com_to_numvertices[seed_set[v]] = 1
-            density[seed_set[v]] = max_density
+        communities.fill(-1)
+        com_to_numvertices.fill(0)
+        for stamp, (v, community_id) in enumerate(seed_set.items()):
+            communities[v] = community_id
+            stamps[v] = stamp
+            com_to_numvertices[community_id] = 1
+            density[community_id] = max_density
 
         # Call to the original FluidC algorithm (with some modification)
-        in_seed_set = deepcopy(seed_set)
-        new_communities = fluidc_modified(G, sorted_vertices, in_seed_set, density, max_density, com_to_numvertices,
-                                          max_iter)
+        new_communities = fluidc_modified(indptr, indices, sorted_vertices, communities, stamps, density, max_density,
+                                          com_to_numvertices, max_iter, cand_ids, cand_weights,
+                                          shuffle_every=shuffle_every)
 
         # Compute NMI (Normalized Mutual Information)
         new_communities_list = nodes_color(G, new_communities)
         if iter != 0:
             NMI = nmi(new_communities_list, old_communities)
             nmi_list.append(NMI)
-            if nmi(new_communities_list, old_communities) < min_NMI:
-                bad_seed_set = bad_seed_set | seed_set
+            if NMI < min_NMI:
+                # Skip the update when all current seeds are already known as bad
+                if not seed_set.keys() <= bad_seed_set:
+                    bad_seed_set.update(seed_set)
                 seed_init_num += 1
                 min_NMI = NMI
 
@@ -182,20 +286,23 @@ def fluidc_plus(G, k, max_iter=100):
         # Each element belong to a different community
         seed_set = {}
         community_idx = 0
-        removed_list = []
+        removed_set = set()
         while community_idx < len(new_communities):
             # Extract possible seed element from a community from which bad seeds were removed
+            # (removed_set only holds nodes of the current community)
             current_community = new_communities[community_idx]
-            current_community = list(set(current_community) - set(removed_list))
-            if not current_community:
+            if len(removed_set) == len(current_community):
                 seed_init_num = 10
                 break
+            # Sample by rejection instead of rebuilding the list of remaining nodes
             new_v = random.choice(current_community)
-            if new_v in list(bad_seed_set.keys()):
-                removed_list.append(new_v)
+            if new_v in removed_set:
+                continue
+            if new_v in bad_seed_set:
+                removed_set.add(new_v)
             else:
                 seed_set[new_v] = community_idx
-                removed_list = []
+                removed_set.clear()
                 community_idx += 1
 
         iter += 1
@@ -50,20 +50,14 @@ def get_communities_from_synth(G):
     Returns:
         communities (list), number of communities (int)
     """
-    nodes = list(G.nodes())
-    comm_idx = 0
-    communities_color = [0] * len(nodes)
-    while nodes:
-        current_node = nodes.pop(0)
-        new_community = G.nodes[current_node]['community']
-        for n in new_community:
-            if n in nodes:
-                communities_color[n] = comm_idx
-                nodes.remove(n)
-        communities_color[int(current_node)] = comm_idx
-        comm_idx += 1
-
-    return communities_color, comm_idx - 1
+    # Map each ground truth community (shared by all its members) to an integer id in a single pass
+    community_ids = {}
+    communities_color = [0] * len(G)
+    for n, community in G.nodes(data='community'):
+        key = tuple(sorted(community))
+        communities_color[int(n)] = community_ids.setdefault(key, len(community_ids))
+
+    return communities_color, len(community_ids) - 1
 
 
 def synthetic_test1(folder, seed):
@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 import matplotlib.cm as cm
 import matplotlib.pyplot as plt
 import networkx as nx
@@ -7,15 +9,8 @@ from sklearn import metrics
 from sklearn.metrics.cluster import adjusted_rand_score as ars
 from sklearn.metrics.cluster import normalized_mutual_info_score as nmi
 
-
-def _invert_dict(orig_dict):
-    return_dict = {}
-    for v, k in orig_dict.items():
-        try:
-            return_dict[k].append(v)
-        except KeyError:
-            return_dict[k] = [v]
-    return return_dict
+# Groundtruth already loaded, keyed by (id(G), name); entries hold G as well so that its id cannot be reused
+_gt_cache = {}
 
 
 def nodes_color(in_graph, communities):
@@ -28,14 +23,31 @@ def nodes_color(in_graph, communities):
     Returns:
         list of colors (list)
     """
-    color_list = [0] * len(in_graph.nodes)
+    # Nodes not assigned to any community keep color 0
+    color_list = np.zeros(len(in_graph.nodes), dtype=np.int32)
 
-    for color in range(len(communities)):
-        node_idxs = communities[color]
-        for j in node_idxs:
-            color_list[j] = color
+    for color, node_idxs in enumerate(communities):
+        color_list[np.fromiter(node_idxs, dtype=np.int64, count=len(node_idxs))] = color
 
-    return color_list
+    return color_list.tolist()
+
+
+def graph_to_csr(G):
+    """
+    Convert graph adjacency to CSR (compressed sparse row) int arrays
+    Args:
+        G: input graph (networkX graph), nodes are expected to be labelled 0..n-1
+
+    Returns:
+        row pointers (numpy array), neighbour indices (numpy array)
+    """
+    adj = G._adj
+    n = len(G)
+    degrees = np.fromiter((len(adj[v]) for v in range(n)), dtype=np.int32, count=n)
+    indptr = np.zeros(n + 1, dtype=np.int32)
+    np.cumsum(degrees, out=indptr[1:])
+    indices = np.fromiter((u for v in range(n) for u in adj[v]), dtype=np.int32, count=int(indptr[-1]))
+    return indptr, indices
 
 
 def from_mtx_to_graph(mtx_file, plot=False):
@@ -49,8 +61,7 @@ def from_mtx_to_graph(mtx_file, plot=False):
         networkX graph
     """
     mtx = mmread(mtx_file)
-    mtx_to_dense = mtx.todense()
-    in_graph = nx.from_numpy_matrix(mtx_to_dense)
+    in_graph = nx.from_scipy_sparse_array(mtx.tocsr())
 
     if plot:
         cmap = cm.get_cmap('jet')
@@ -79,9 +90,11 @@ def purity_score(true_labels, pred_labels):
     return np.sum(np.amax(contingency_matrix, axis=0)) / np.sum(contingency_matrix)
 
 
+@lru_cache(maxsize=None)
 def graph_loader(name):
     """
-    Load real graph corresponding to input name
+    Load real graph corresponding to input name (cached, keys are bounded by the real graph names accepted below).
+    The returned graph is frozen since it is shared by every caller.
     Args:
         name: real graph name (string)
 
@@ -109,12 +122,12 @@ def graph_loader(name):
         communities_number = 3
     else:
         raise ValueError("Improper graph name as input")
-    return G, communities_number
+    return nx.freeze(G), communities_number
 
 
 def gt_loader(G, name):
     """
-    Load groundtruth from real input graph G and convert data to int
+    Load groundtruth from real input graph G and convert data to int (cached for each graph and name)
     Args:
         G: input graph (networkX graph)
         name: real graph name (string)
@@ -122,35 +135,32 @@ def gt_loader(G, name):
     Returns:
         groundtruth (list)
     """
-    gt = []
-    for i in range(len(G)):
-        if name == "karate":
-            gt_com = G.nodes[i]["club"]
-            if gt_com == "Officer":
-                gt.append(0)
-            elif gt_com == "Mr. Hi":
-                gt.append(1)
-            else:
-                raise ValueError("Invalid community label")
-        elif name == 'dolphins':
-            gt_com = G.nodes[i]["group"]
-            gt.append(gt_com)
-        elif name == "football":
-            gt_com = G.nodes[i]["value"]
-            gt.append(gt_com)
-        elif name == "citeseer":
-            gt_com = G.nodes[i]["community"]
-            gt.append(gt_com)
-        elif name == "polbooks":
-            gt_com = G.nodes[i]["value"]
-            if gt_com == "n":
-                gt.append(0)
-            elif gt_com == "c":
-                gt.append(1)
-            elif gt_com == "l":
-                gt.append(2)
-            else:
-                raise ValueError("Invalid community label")
+    key = (id(G), name)
+    if key in _gt_cache:
+        return list(_gt_cache[key][1])
+
+    nodes = G.nodes
+    vertices = range(len(G))
+    if name == "karate":
+        attr, labels = "club", {"Officer": 0, "Mr. Hi": 1}
+    elif name == "polbooks":
+        attr, labels = "value", {"n": 0, "c": 1, "l": 2}
+    elif name == 'dolphins':
+        attr, labels = "group", None
+    elif name == "football":
+        attr, labels = "value", None
+    elif name == "citeseer":
+        attr, labels = "community", None
+    else:
+        return []
+
+    gt = [nodes[i][attr] for i in vertices]
+    # Convert string labels to int
+    if labels is not None:
+        if set(gt) - labels.keys():
+            raise ValueError("Invalid community label")
+        gt = [labels[gt_com] for gt_com in gt]
+    _gt_cache[key] = (G, tuple(gt))
     return gt
 
 